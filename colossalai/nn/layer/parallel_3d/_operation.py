@@ -11,11 +11,14 @@ from colossalai.core import global_context as gpc
 from colossalai.utils import empty_cache, get_current_device
 from torch import Tensor
 
+from ._utils import autocast_bwd, autocast_fwd
+
 
 class Matmul_AB_3D(torch.autograd.Function):
     """Matrix multiplication for :math:`C = AB`
     """
     @staticmethod
+    @autocast_fwd
     def forward(ctx: Any,
                 A: Tensor,
                 B: Tensor,
@@ -52,6 +55,7 @@ class Matmul_AB_3D(torch.autograd.Function):
         return out
 
     @staticmethod
+    @autocast_bwd
     def backward(ctx: Any, output_grad: Tensor) -> Tuple[Tensor, ...]:
         A, B = ctx.saved_tensors
         with torch.no_grad():
@@ -72,6 +76,7 @@ class Matmul_ABT_3D(torch.autograd.Function):
     """Matrix multiplication for :math:`C = AB^T`
     """
     @staticmethod
+    @autocast_fwd
     def forward(ctx: Any,
                 A: Tensor,
                 B: Tensor,
@@ -105,6 +110,7 @@ class Matmul_ABT_3D(torch.autograd.Function):
         return out
 
     @staticmethod
+    @autocast_bwd
     def backward(ctx: Any, output_grad: Tensor) -> Tuple[Tensor, ...]:
         A, B = ctx.saved_tensors
         with torch.no_grad():
@@ -125,6 +131,7 @@ class Matmul_ATB_3D(torch.autograd.Function):
     """Matrix multiplication for :math:`C = A^TB`
     """
     @staticmethod
+    @autocast_fwd
     def forward(ctx: Any,
                 A: Tensor,
                 B: Tensor,
@@ -160,6 +167,7 @@ class Matmul_ATB_3D(torch.autograd.Function):
         return out
 
     @staticmethod
+    @autocast_bwd
     def backward(ctx: Any, output_grad: Tensor) -> Tuple[Tensor, ...]:
         A, B = ctx.saved_tensors
         with torch.no_grad():
@@ -188,7 +196,9 @@ class Add_3D(torch.autograd.Function):
         # bias: [h/q^2]
         ranks_in_group = gpc.get_ranks_in_group(input_parallel_mode)
         src_rank = ranks_in_group[gpc.get_local_rank(output_parallel_mode)]
-        bias_temp = bias.clone()
+        # match the input dtype, e.g. under autocast, so the sum is not
+        # promoted back to the bias dtype
+        bias_temp = bias.to(input_.dtype, copy=True)
         dist.broadcast(bias_temp,
                        src=src_rank,
                        group=gpc.get_group(input_parallel_mode))
@@ -2,7 +2,9 @@
 # -*- encoding: utf-8 -*-
 
 import os
+from functools import wraps
 
+import torch
 from colossalai.constants import DEPTH_3D
 from colossalai.context.parallel_mode import ParallelMode
 from colossalai.core import global_context as gpc
@@ -47,3 +49,40 @@ def dbg_check_shape(tensor: Tensor, shape: tuple):
         print(tensor.shape)
     assert tensor.shape == shape, \
         '{} does not match {}'.format(tensor.shape, shape)
+
+
+def autocast_fwd(fwd):
+    """Records the autocast state, including its dtype, of an autograd
+    function's forward so that :func:`autocast_bwd` can replay it
+    """
+    @wraps(fwd)
+    def decorate_fwd(ctx, *args, **kwargs):
+        if hasattr(torch, 'is_autocast_enabled'):
+            ctx.had_autocast_in_fwd = torch.is_autocast_enabled()
+        else:
+            ctx.had_autocast_in_fwd = False
+        if hasattr(torch, 'get_autocast_gpu_dtype'):
+            ctx.autocast_kwargs = dict(dtype=torch.get_autocast_gpu_dtype())
+        else:
+            ctx.autocast_kwargs = dict()
+        return fwd(ctx, *args, **kwargs)
+
+    return decorate_fwd
+
+
+def autocast_bwd(bwd):
+    """Runs an autograd function's backward under the autocast state recorded
+    by :func:`autocast_fwd`, e.g. bfloat16 rather than the default float16
+    """
+    @wraps(bwd)
+    def decorate_bwd(ctx, *args):
+        if not ctx.had_autocast_in_fwd:
+            return bwd(ctx, *args)
+        if hasattr(torch, 'autocast'):
+            autocast = torch.autocast('cuda', **ctx.autocast_kwargs)
+        else:
+            autocast = torch.cuda.amp.autocast()
+        with autocast:
+            return bwd(ctx, *args)
+
+    return decorate_bwd
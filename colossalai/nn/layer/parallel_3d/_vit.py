@@ -1,13 +1,17 @@
 import math
+from contextlib import nullcontext
+from functools import partial
 from typing import Tuple
 
 import torch
 import torch.distributed as dist
+import torch.nn.functional as F
 from colossalai.context import ParallelMode, seed
 from colossalai.core import global_context as gpc
 from colossalai.registry import LAYERS
 from colossalai.utils import checkpoint, get_current_device
 from torch import Tensor, dtype, nn
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 from .._common_utils import ACT2FN, divide, set_tensor_parallel_attribute
 from ..vanilla_vision_transformer.layers import to_2tuple
@@ -15,6 +19,19 @@ from ._utils import get_depth_from_env
 from .layers import Linear3D
 
 
+def _check_compute_dtype(dtype: dtype = None):
+    if dtype is not None and not hasattr(torch, 'autocast'):
+        raise RuntimeError(
+            'compute_dtype requires torch.autocast, '
+            'which is only available in PyTorch 1.10 and later')
+
+
+def _autocast(dtype: dtype = None):
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type='cuda', dtype=dtype)
+
+
 @LAYERS.register_module
 class ViTPatchEmbedding3D(nn.Module):
     """ 3D Image to Patch Embedding
@@ -44,7 +61,8 @@ class ViTPatchEmbedding3D(nn.Module):
         self.input_parallel_mode = ParallelMode.PARALLEL_3D_INPUT
         self.weight_parallel_mode = ParallelMode.PARALLEL_3D_WEIGHT
         self.output_parallel_mode = ParallelMode.PARALLEL_3D_OUTPUT
-        img_size = to_2tuple(img_size)
+        # to_2tuple passes iterables such as lists through unchanged
+        img_size = tuple(to_2tuple(img_size))
         patch_size = to_2tuple(patch_size)
         self.img_size = img_size
         self.patch_size = patch_size
@@ -54,6 +72,18 @@ class ViTPatchEmbedding3D(nn.Module):
         self.embed_size_per_partition = divide(self.embed_size, self.depth)
         self.num_patches = self.grid_size[0] * self.grid_size[1]
         self.flatten = flatten
+        # cached to keep the singleton lookups off the per-step path
+        self._w_rank = gpc.get_local_rank(self.weight_parallel_mode)
+        self._i_rank = gpc.get_local_rank(self.input_parallel_mode)
+        self._w_group = gpc.get_group(self.weight_parallel_mode)
+        self._i_group = gpc.get_group(self.input_parallel_mode)
+        self._w_size = gpc.get_world_size(self.weight_parallel_mode)
+        self._i_size = gpc.get_world_size(self.input_parallel_mode)
+        # groups of a single rank have nothing to synchronize
+        self._grad_sync_groups = tuple(
+            group for group, size in ((self._i_group, self._i_size),
+                                      (self._w_group, self._w_size))
+            if size > 1)
 
         with seed(ParallelMode.TENSOR):
             self.proj = nn.Conv2d(in_chans,
@@ -69,10 +99,7 @@ class ViTPatchEmbedding3D(nn.Module):
         self.pos_drop = nn.Dropout(drop_prob)
 
         self._sync_parameters()
-        self.proj.weight.register_hook(self._sync_grad_hook)
-        self.proj.bias.register_hook(self._sync_grad_hook)
-        self.cls_token.register_hook(self._sync_grad_hook)
-        self.pos_embed.register_hook(self._sync_grad_hook)
+        self._register_grad_sync_hooks()
         self._set_tensor_parallel_attribute()
 
     def _set_tensor_parallel_attribute(self):
@@ -86,51 +113,91 @@ class ViTPatchEmbedding3D(nn.Module):
 
     def _sync_parameters(self):
         self.to(get_current_device())
-        weight_src_rank = gpc.get_ranks_in_group(self.weight_parallel_mode)[0]
-        dist.broadcast(self.proj.weight,
-                       src=weight_src_rank,
-                       group=gpc.get_group(self.weight_parallel_mode))
-        dist.broadcast(self.proj.bias,
-                       src=weight_src_rank,
-                       group=gpc.get_group(self.weight_parallel_mode))
-        input_src_rank = gpc.get_ranks_in_group(self.input_parallel_mode)[0]
-        dist.broadcast(self.proj.weight,
-                       src=input_src_rank,
-                       group=gpc.get_group(self.input_parallel_mode))
-        dist.broadcast(self.proj.bias,
-                       src=input_src_rank,
-                       group=gpc.get_group(self.input_parallel_mode))
-        set_tensor_parallel_attribute(self.proj.weight)
-        set_tensor_parallel_attribute(self.proj.bias)
-        set_tensor_parallel_attribute(self.cls_token)
-        set_tensor_parallel_attribute(self.pos_embed)
-
-    def _sync_grad_hook(self, grad) -> None:
-        dist.all_reduce(grad, group=gpc.get_group(self.input_parallel_mode))
-        dist.all_reduce(grad, group=gpc.get_group(self.weight_parallel_mode))
+        # coalesce the conv weight & bias so that each group needs only one broadcast
+        params = [self.proj.weight.data, self.proj.bias.data]
+        if self._w_size > 1:
+            weight_src_rank = gpc.get_ranks_in_group(
+                self.weight_parallel_mode)[0]
+            self._broadcast_coalesced(params, weight_src_rank, self._w_group)
+        # the second broadcast propagates what the first one delivered, so the
+        # two groups cannot be broadcast concurrently
+        if self._i_size > 1:
+            input_src_rank = gpc.get_ranks_in_group(
+                self.input_parallel_mode)[0]
+            self._broadcast_coalesced(params, input_src_rank, self._i_group)
+
+    @staticmethod
+    def _broadcast_coalesced(tensors, src, group):
+        flat = _flatten_dense_tensors(tensors)
+        dist.broadcast(flat, src=src, group=group)
+        for buf, synced in zip(tensors,
+                               _unflatten_dense_tensors(flat, tensors)):
+            buf.copy_(synced)
+
+    def _register_grad_sync_hooks(self):
+        self._grad_sync_params = (self.proj.weight, self.proj.bias,
+                                  self.cls_token, self.pos_embed)
+        self._pending_grads = dict()
+        if len(self._grad_sync_groups) > 0:
+            for idx, param in enumerate(self._grad_sync_params):
+                param.register_hook(partial(self._stash_grad, idx))
+
+    def _stash_grad(self, idx: int, grad: Tensor) -> Tensor:
+        # gradients of all parameters are bucketed and reduced together once
+        # they have been accumulated, at the end of the backward pass
+        if len(self._pending_grads) == 0:
+            torch.autograd.Variable._execution_engine.queue_callback(
+                self._sync_grads)
+        if idx in self._pending_grads:
+            self._pending_grads[idx] = self._pending_grads[idx] + grad
+        else:
+            self._pending_grads[idx] = grad
         return grad
 
+    def _sync_grads(self):
+        indices, grads = zip(*sorted(self._pending_grads.items()))
+        self._pending_grads = dict()
+        flat = _flatten_dense_tensors(grads)
+        for group in self._grad_sync_groups:
+            dist.all_reduce(flat, group=group)
+        for idx, grad, synced in zip(indices, grads,
+                                     _unflatten_dense_tensors(flat, grads)):
+            # only replace what this backward pass added, so that gradients
+            # accumulated over previous steps are not reduced again
+            self._grad_sync_params[idx].grad.add_(synced - grad)
+
     def forward(self, x: Tensor) -> Tensor:
         B, C, H, W = x.shape
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        if __debug__ and (H, W) != self.img_size:
+            raise ValueError(
+                f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+            )
         x = self.proj(x)
         if self.flatten:
             x = x.flatten(2).transpose(1, 2)  # BCHW -> BNC
 
         # split a partition from embedded states
-        x = torch.chunk(x, self.depth, dim=0)[gpc.get_local_rank(
-            self.weight_parallel_mode)].contiguous()
-        x = torch.chunk(x, self.depth, dim=0)[gpc.get_local_rank(
-            self.input_parallel_mode)].contiguous()
+        # [b,s,h/q] --> [b/q^2,s,h/q] in a single slice
+        chunk_size = divide(B, self.depth**2)
+        start = (self._w_rank * self.depth + self._i_rank) * chunk_size
+        x = x[start:start + chunk_size]
 
         # add cls token & pos embedding
         # [b/q^2,s,h/q] --> [b/q^2, 1+s, h/q]
-        cls_token = self.cls_token.expand(x.shape[0], -1, -1)
-        x = torch.cat((cls_token, x), dim=1)
-
+        # the partition is written straight into the output instead of being
+        # copied out first and concatenated afterwards
+        out = x.new_empty((chunk_size, x.shape[1] + 1, x.shape[2]))
+        out[:, 0].copy_(self.cls_token[0, 0])
+        out[:, 1:].copy_(x)
+        x = out
+
+        # x is freshly allocated above, so it can be updated in place
         with seed(ParallelMode.TENSOR):
-            x = self.pos_drop(x + self.pos_embed)
+            x.add_(self.pos_embed)
+            x = F.dropout(x,
+                          p=self.pos_drop.p,
+                          training=self.training,
+                          inplace=True)
 
         return x
 
@@ -157,6 +224,16 @@ class ViTSelfAttention3D(nn.Module):
     :type dtype: dtype, optional
     :param bias: whether to add bias, defaults to True
     :type bias: bool, optional
+    :param checkpoint: whether to use activation checkpointing on the whole layer, defaults to False
+    :type checkpoint: bool, optional
+    :param selective_checkpoint: with ``checkpoint``, recompute only the attention core instead of the
+        whole layer, so that the GEMMs are not re-run. The QKV and context activations are then kept,
+        which saves less memory than whole-layer checkpointing. Ignored when the fused
+        scaled_dot_product_attention is available, as it never materializes the attention scores,
+        defaults to False
+    :type selective_checkpoint: bool, optional
+    :param compute_dtype: dtype to autocast the forward computation to, e.g. torch.bfloat16, defaults to None
+    :type compute_dtype: dtype, optional
     """
     def __init__(self,
                  hidden_size: int,
@@ -165,7 +242,9 @@ class ViTSelfAttention3D(nn.Module):
                  hidden_dropout_prob: float,
                  dtype: dtype = None,
                  bias: bool = True,
-                 checkpoint: bool = False):
+                 checkpoint: bool = False,
+                 compute_dtype: dtype = None,
+                 selective_checkpoint: bool = False):
         super().__init__()
         self.depth = get_depth_from_env()
         self.input_parallel_mode = ParallelMode.PARALLEL_3D_INPUT
@@ -175,7 +254,13 @@ class ViTSelfAttention3D(nn.Module):
         self.num_attention_heads = divide(num_attention_heads, self.depth)
         self.attention_head_size = divide(hidden_size, num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
+        self._scale = 1.0 / math.sqrt(self.attention_head_size)
         self.checkpoint = checkpoint
+        self._use_sdpa = hasattr(F, 'scaled_dot_product_attention')
+        self.selective_checkpoint = checkpoint and selective_checkpoint and \
+            not self._use_sdpa
+        _check_compute_dtype(compute_dtype)
+        self.compute_dtype = compute_dtype
 
         self.query_key_value = Linear3D(self.hidden_size,
                                         3 * self.hidden_size,
@@ -191,46 +276,70 @@ class ViTSelfAttention3D(nn.Module):
                               dtype=dtype,
                               bias=bias)
         self.dropout = nn.Dropout(hidden_dropout_prob)
-        self.softmax = nn.Softmax(dim=-1)
 
     def groups_for_next_layer(self) -> Tuple[ParallelMode, ParallelMode]:
         return self.input_parallel_mode, self.weight_parallel_mode
 
-    def _forward(self, hidden_states: Tensor) -> Tensor:
+    def _compute_qkv(self, hidden_states: Tensor) -> Tuple[Tensor, ...]:
         query_key_value = self.query_key_value(hidden_states)
         new_qkv_shape = query_key_value.shape[:-1] + \
                         (self.num_attention_heads, 3 * self.attention_head_size)
         query_key_value = query_key_value.view(new_qkv_shape)
+        # [b, s, heads, 3*head_size] --> [b, heads, s, 3*head_size]
+        # this only permutes strides: each of q/k/v keeps a unit-stride
+        # head_size dim, which scaled_dot_product_attention takes without a
+        # copy; the matmul fallback still copies, as [b, heads] can't be folded
         query_key_value = query_key_value.permute((0, 2, 1, 3))
-        query_layer, key_layer, value_layer = torch.chunk(query_key_value,
-                                                          3,
-                                                          dim=-1)
-
-        attention_scores = torch.matmul(query_layer,
-                                        key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / math.sqrt(
-            self.attention_head_size)
-        attention_probs = self.softmax(attention_scores)
-        with seed(ParallelMode.TENSOR):
-            attention_probs = self.attention_dropout(attention_probs)
-
-        context_layer = torch.matmul(attention_probs, value_layer)
+        return torch.chunk(query_key_value, 3, dim=-1)
+
+    def _compute_attn(self, query_layer: Tensor, key_layer: Tensor,
+                      value_layer: Tensor) -> Tensor:
+        if self._use_sdpa:
+            # fused attention kernel, the [b, heads, s, s] scores are never
+            # materialized
+            dropout_p = self.attention_dropout.p if self.training else 0.
+            with seed(ParallelMode.TENSOR):
+                context_layer = F.scaled_dot_product_attention(
+                    query_layer, key_layer, value_layer, dropout_p=dropout_p)
+        else:
+            # scale q rather than the s times larger scores
+            query_layer = query_layer * self._scale
+            attention_scores = torch.matmul(query_layer,
+                                            key_layer.transpose(-1, -2))
+            attention_probs = F.softmax(attention_scores, dim=-1)
+            with seed(ParallelMode.TENSOR):
+                attention_probs = self.attention_dropout(attention_probs)
+
+            context_layer = torch.matmul(attention_probs, value_layer)
         context_layer = context_layer.transpose(1, 2)
         new_context_layer_shape = context_layer.size()[:-2] + (
             self.all_head_size, )
-        context_layer = context_layer.reshape(new_context_layer_shape)
+        return context_layer.reshape(new_context_layer_shape)
 
+    def _project(self, context_layer: Tensor) -> Tensor:
         output = self.dense(context_layer)
         with seed(ParallelMode.TENSOR):
             output = self.dropout(output)
-
         return output
 
+    def _forward(self, hidden_states: Tensor) -> Tensor:
+        with _autocast(self.compute_dtype):
+            query_layer, key_layer, value_layer = self._compute_qkv(
+                hidden_states)
+            if self.selective_checkpoint:
+                # only the attention core is recomputed, the GEMMs are not
+                context_layer = checkpoint(self._compute_attn, query_layer,
+                                           key_layer, value_layer)
+            else:
+                context_layer = self._compute_attn(query_layer, key_layer,
+                                                   value_layer)
+            return self._project(context_layer)
+
     def _checkpoint_forward(self, hidden_states: Tensor) -> Tensor:
         return checkpoint(self._forward, hidden_states)
 
     def forward(self, hidden_states: Tensor) -> Tensor:
-        if self.checkpoint:
+        if self.checkpoint and not self.selective_checkpoint:
             return self._checkpoint_forward(hidden_states)
         else:
             return self._forward(hidden_states)
@@ -258,6 +367,17 @@ class ViTMLP3D(nn.Module):
     :type dtype: dtype, optional
     :param bias: whether to add bias, defaults to True
     :type bias: bool, optional
+    :param checkpoint: whether to use activation checkpointing on the whole layer, defaults to False
+    :type checkpoint: bool, optional
+    :param selective_checkpoint: with ``checkpoint``, recompute only the activation function instead of
+        the whole layer, so that the GEMMs are not re-run. The inputs of the activation and of dense_2
+        are then kept, which saves less memory than whole-layer checkpointing, defaults to False
+    :type selective_checkpoint: bool, optional
+    :param compute_dtype: dtype to autocast the forward computation to, e.g. torch.bfloat16, defaults to None
+    :type compute_dtype: dtype, optional
+    :param compile_activation: whether to fuse the activation function with torch.compile
+        when it is available, defaults to False
+    :type compile_activation: bool, optional
     """
     def __init__(self,
                  hidden_size: int,
@@ -266,7 +386,10 @@ class ViTMLP3D(nn.Module):
                  hidden_act: str = 'gelu',
                  dtype: dtype = None,
                  bias: bool = True,
-                 checkpoint: bool = False):
+                 checkpoint: bool = False,
+                 compute_dtype: dtype = None,
+                 compile_activation: bool = False,
+                 selective_checkpoint: bool = False):
         super().__init__()
         self.depth = get_depth_from_env()
         self.input_parallel_mode = ParallelMode.PARALLEL_3D_INPUT
@@ -275,6 +398,9 @@ class ViTMLP3D(nn.Module):
         self.hidden_size = hidden_size
         self.mlp_ratio = mlp_ratio
         self.checkpoint = checkpoint
+        self.selective_checkpoint = checkpoint and selective_checkpoint
+        _check_compute_dtype(compute_dtype)
+        self.compute_dtype = compute_dtype
 
         self.dense_1 = Linear3D(self.hidden_size,
                                 self.mlp_ratio * self.hidden_size,
@@ -283,6 +409,11 @@ class ViTMLP3D(nn.Module):
                                 dtype=dtype,
                                 bias=bias)
         self.activation_func = ACT2FN[hidden_act]
+        if compile_activation and hasattr(torch, 'compile'):
+            # the activation is a chain of elementwise kernels, e.g. erf-based
+            # gelu, which inductor fuses into one
+            self.activation_func = torch.compile(self.activation_func,
+                                                 dynamic=True)
         self.dense_2 = Linear3D(self.mlp_ratio * self.hidden_size,
                                 self.hidden_size,
                                 self.output_parallel_mode,
@@ -295,18 +426,25 @@ class ViTMLP3D(nn.Module):
         return self.input_parallel_mode, self.weight_parallel_mode
 
     def _forward(self, hidden_states: Tensor) -> Tensor:
-        intermediate_output = self.dense_1(hidden_states)
-        intermediate_output = self.activation_func(intermediate_output)
-        output = self.dense_2(intermediate_output)
-        with seed(ParallelMode.TENSOR):
-            output = self.dropout(output)
-        return output
+        with _autocast(self.compute_dtype):
+            intermediate_output = self.dense_1(hidden_states)
+            if self.selective_checkpoint:
+                # only the activation is recomputed, the GEMMs are not
+                intermediate_output = checkpoint(self.activation_func,
+                                                 intermediate_output)
+            else:
+                intermediate_output = self.activation_func(
+                    intermediate_output)
+            output = self.dense_2(intermediate_output)
+            with seed(ParallelMode.TENSOR):
+                output = self.dropout(output)
+            return output
 
     def _checkpoint_forward(self, hidden_states: Tensor) -> Tensor:
         return checkpoint(self._forward, hidden_states)
 
     def forward(self, hidden_states: Tensor) -> Tensor:
-        if self.checkpoint:
+        if self.checkpoint and not self.selective_checkpoint:
             return self._checkpoint_forward(hidden_states)
         else:
             return self._forward(hidden_states)
@@ -346,6 +484,7 @@ class ViTHead3D(nn.Module):
         out_features = math.ceil(self.num_classes /
                                  (self.depth**2)) * (self.depth**2)
         self.num_classes_per_partition = divide(self.num_classes, self.depth)
+        self.padded = out_features != self.num_classes
         self.linear = Linear3D(self.in_features,
                                out_features,
                                self.input_parallel_mode,
@@ -361,7 +500,10 @@ class ViTHead3D(nn.Module):
         x = x[:, 0]
         # [b/q^2, h/q] --> [b/q^2, c/q]
         x = self.linear(x)
-        return x[:, :self.num_classes_per_partition]
+        if self.padded:
+            # drop the columns padded up to a multiple of depth^2
+            x = x[:, :self.num_classes_per_partition]
+        return x
 
     def extra_repr(self):
         return 'in_features={}, num_classes={}'.format(self.in_features,
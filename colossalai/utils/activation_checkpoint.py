@@ -24,6 +24,11 @@ class CheckpointFunction(torch.autograd.Function):
             ctx.had_autocast_in_fwd = torch.is_autocast_enabled()
         else:
             ctx.had_autocast_in_fwd = False
+        # recompute with the same autocast dtype, e.g. bfloat16
+        if hasattr(torch, 'get_autocast_gpu_dtype'):
+            ctx.autocast_kwargs = dict(dtype=torch.get_autocast_gpu_dtype())
+        else:
+            ctx.autocast_kwargs = dict()
 
         # Save non-tensor inputs in ctx, keep a placeholder None for tensors
         # to be filled out during the backward.
@@ -74,7 +79,8 @@ class CheckpointFunction(torch.autograd.Function):
 
         detached_inputs = detach_variable(tuple(inputs))
         if ctx.had_autocast_in_fwd:
-            with torch.enable_grad(), torch.cuda.amp.autocast():
+            with torch.enable_grad(), torch.cuda.amp.autocast(
+                    **ctx.autocast_kwargs):
                 outputs = ctx.run_function(*detached_inputs)
         else:
             with torch.enable_grad():
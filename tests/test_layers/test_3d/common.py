@@ -13,3 +13,7 @@ IMG_SIZE = 32
 
 def check_equal(A, B):
     return torch.allclose(A, B, rtol=1e-5, atol=1e-2)
+
+
+def check_equal_bf16(A, B):
+    return torch.allclose(A, B, rtol=5e-2, atol=5e-2)
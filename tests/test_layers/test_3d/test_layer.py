@@ -208,6 +208,47 @@ def check_layernorm():
     return fwd_end - fwd_start, bwd_end - bwd_start
 
 
+def check_variant(name, layer_name, args, ref_kwargs, var_kwargs, A,
+                  equal=check_equal, prepare=None):
+    """Checks that a layer built with ``var_kwargs`` (and then passed to
+    ``prepare`` if given) gives the same outputs and gradients as the one
+    built with ``ref_kwargs`` and identical parameters
+    """
+    rank = torch.distributed.get_rank()
+    device = get_current_device()
+    logger = get_global_dist_logger()
+
+    layer = LAYERS.get_module(layer_name)(*args, **ref_kwargs).to(device)
+    variant = LAYERS.get_module(layer_name)(*args, **var_kwargs).to(device)
+    variant.load_state_dict(layer.state_dict())
+    if prepare is not None:
+        prepare(variant)
+
+    A_ref = A.detach().clone()
+    A_ref.requires_grad = True
+    out_ref = layer(A_ref)
+    A_var = A.detach().clone()
+    A_var.requires_grad = True
+    out = variant(A_var)
+    logger.info('Rank {} {} forward: {}'.format(
+        rank, name, equal(out.float(), out_ref.float())))
+
+    grad = torch.randn(out_ref.shape, dtype=A.dtype, device=device)
+    out_ref.backward(grad.to(out_ref.dtype))
+    out.backward(grad.to(out.dtype))
+    logger.info('Rank {} {} backward (input_grad): {}'.format(
+        rank, name, equal(A_var.grad.float(), A_ref.grad.float())))
+    for (param_name, param_ref), param in zip(layer.named_parameters(),
+                                              variant.parameters()):
+        if param_ref.grad is None:
+            res = param.grad is None
+        else:
+            res = equal(param.grad.float(), param_ref.grad.float())
+        logger.info('Rank {} {} backward ({}_grad): {}'.format(
+            rank, name, param_name, res))
+    return out
+
+
 def check_attention():
     rank = torch.distributed.get_rank()
     device = get_current_device()
@@ -258,6 +299,37 @@ def check_attention():
         'self attention backward: pass | {:.3f} s'.format(bwd_end - bwd_start),
         logger)
 
+    args = (HIDDEN_SIZE, NUM_ATTENTION_HEADS, 0., 0.)
+    kwargs = dict(dtype=dtype, bias=True)
+    check_variant('self attention (checkpoint)', 'ViTSelfAttention3D', args,
+                  kwargs, dict(kwargs, checkpoint=True), A)
+    check_variant('self attention (selective checkpoint)',
+                  'ViTSelfAttention3D', args, kwargs,
+                  dict(kwargs, checkpoint=True, selective_checkpoint=True), A)
+    if hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+
+        def disable_sdpa(layer):
+            layer._use_sdpa = False
+
+        # fused kernel against the explicit (pre-scaled q) softmax/matmul math
+        check_variant('self attention (sdpa vs matmul)', 'ViTSelfAttention3D',
+                      args, kwargs, kwargs, A, prepare=disable_sdpa)
+    if hasattr(torch, 'autocast'):
+        out = check_variant('self attention (bf16)', 'ViTSelfAttention3D',
+                            args, kwargs,
+                            dict(kwargs, compute_dtype=torch.bfloat16), A,
+                            equal=check_equal_bf16)
+        logger.info('Rank {} self attention (bf16) output dtype: {}'.format(
+            rank, out.dtype == torch.bfloat16))
+        # recomputation has to replay the bfloat16 autocast of the forward
+        kwargs = dict(kwargs, compute_dtype=torch.bfloat16)
+        check_variant('self attention (bf16 checkpoint)', 'ViTSelfAttention3D',
+                      args, kwargs, dict(kwargs, checkpoint=True), A)
+        check_variant('self attention (bf16 selective checkpoint)',
+                      'ViTSelfAttention3D', args, kwargs,
+                      dict(kwargs, checkpoint=True, selective_checkpoint=True),
+                      A)
+
     return fwd_end - fwd_start, bwd_end - bwd_start
 
 
@@ -304,6 +376,30 @@ def check_mlp():
     print_rank_0('mlp backward: pass | {:.3f} s'.format(bwd_end - bwd_start),
                  logger)
 
+    args = (HIDDEN_SIZE, 1, 0., 'gelu')
+    kwargs = dict(dtype=dtype, bias=True)
+    check_variant('mlp (checkpoint)', 'ViTMLP3D', args, kwargs,
+                  dict(kwargs, checkpoint=True), A)
+    check_variant('mlp (selective checkpoint)', 'ViTMLP3D', args, kwargs,
+                  dict(kwargs, checkpoint=True, selective_checkpoint=True), A)
+    if hasattr(torch, 'compile'):
+        check_variant('mlp (compiled activation)', 'ViTMLP3D', args, kwargs,
+                      dict(kwargs, compile_activation=True), A)
+    if hasattr(torch, 'autocast'):
+        out = check_variant('mlp (bf16)', 'ViTMLP3D', args, kwargs,
+                            dict(kwargs, compute_dtype=torch.bfloat16), A,
+                            equal=check_equal_bf16)
+        logger.info('Rank {} mlp (bf16) output dtype: {}'.format(
+            rank, out.dtype == torch.bfloat16))
+        # recomputation has to replay the bfloat16 autocast of the forward
+        kwargs = dict(kwargs, compute_dtype=torch.bfloat16)
+        check_variant('mlp (bf16 checkpoint)', 'ViTMLP3D', args, kwargs,
+                      dict(kwargs, checkpoint=True), A)
+        check_variant('mlp (bf16 selective checkpoint)', 'ViTMLP3D', args,
+                      kwargs,
+                      dict(kwargs, checkpoint=True, selective_checkpoint=True),
+                      A)
+
     return fwd_end - fwd_start, bwd_end - bwd_start
 
 